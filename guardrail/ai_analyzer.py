@@ -4,28 +4,191 @@ AI-Powered Security Guardrail Analyzer
 Aggregates security scan results and uses OpenAI to make intelligent deployment decisions.
 """
 
+import argparse
+import asyncio
+import hashlib
+import importlib.util
 import json
 import os
+import re
 import sys
-from typing import Dict, List, Any, Tuple
+import time
+from array import array
+from collections import Counter
+from itertools import islice
+from typing import Dict, List, Any, Optional, Tuple
 from pathlib import Path
+from types import MappingProxyType
+import httpx
 import openai
 from datetime import datetime
 
+try:
+    import orjson
+    _json_loads = orjson.loads
+    _json_dumps = orjson.dumps
+except ImportError:  # orjson is optional; stdlib json also accepts bytes
+    _json_loads = json.loads
+
+    def _json_dumps(obj: Any) -> bytes:
+        return json.dumps(obj).encode('utf-8')
+
+try:
+    import aiofiles
+except ImportError:  # aiofiles is optional; reads fall back to worker threads
+    aiofiles = None
+
+try:
+    import ijson
+except ImportError:  # ijson is optional; large reports are parsed in one go
+    ijson = None
+
+try:
+    import tiktoken
+except ImportError:  # tiktoken is optional; token counts are estimated from length
+    tiktoken = None
+
+try:
+    import numpy as np
+    from numba import njit
+except ImportError:  # numba is optional; severities are tallied in pure Python
+    np = None
+    njit = None
+
+# Reports larger than this are streamed item by item instead of fully parsed
+STREAM_THRESHOLD_BYTES = 5 * 1024 * 1024
+
+# Below this many Semgrep findings the JIT compile cost outweighs the faster tally
+JIT_MIN_FINDINGS = 10_000
+
+# Token budget for the critical/high finding lines included in the AI prompt
+PROMPT_FINDINGS_TOKEN_BUDGET = 1500
+
+# The first critical and first high finding are always listed, their descriptions cut to this size
+PROMPT_FIRST_ROW_DESCRIPTION_TOKENS = 100
+
+# AI decisions are cached here, keyed on a hash of the model and prompt
+DEFAULT_CACHE_DIR = Path(os.getenv('GUARDRAIL_CACHE_DIR', Path.home() / '.cache' / 'guardrail'))
+
+# OpenAI client resilience: transient 429/5xx responses are retried with backoff,
+# and one keep-alive (HTTP/2 when h2 is installed) connection pool is reused
+OPENAI_MAX_RETRIES = 3
+OPENAI_TIMEOUT = 30.0
+HTTP2_AVAILABLE = importlib.util.find_spec('h2') is not None
+
+# Seconds to wait on a batch dispatch service (it may hold requests for a short window)
+BATCH_ENDPOINT_TIMEOUT = 60
+
+# Polling schedule for OpenAI Batch API jobs (exponential backoff, in seconds)
+BATCH_POLL_INITIAL_DELAY = 5
+BATCH_POLL_MAX_DELAY = 300
+# Give up well inside GitHub's 6 h job limit so the fallback decision still runs
+BATCH_MAX_WAIT = 4 * 60 * 60
+BATCH_TERMINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+
+SYSTEM_PROMPT = ("You are an expert security engineer reviewing deployment readiness. "
+                 "Be thorough but practical in your analysis.")
+
+# Interned severity and tool names shared by every aggregated finding
+SEV_CRIT = sys.intern('critical')
+SEV_HIGH = sys.intern('high')
+SEV_MED = sys.intern('medium')
+SEV_LOW = sys.intern('low')
+SEV_INFO = sys.intern('info')
+SEVERITIES = (SEV_CRIT, SEV_HIGH, SEV_MED, SEV_LOW)
+
+TOOL_GITLEAKS = sys.intern('Gitleaks')
+TOOL_SEMGREP = sys.intern('Semgrep')
+TOOL_OPA = sys.intern('OPA/Conftest')
+
+# Semgrep severities are encoded as int8 codes while parsing; unknown values count as low
+SEMGREP_SEV_CODES = MappingProxyType({'INFO': 0, 'WARNING': 1, 'ERROR': 2})
+SEV_BY_CODE = (SEV_LOW, SEV_MED, SEV_HIGH, SEV_CRIT)
+
+# Shared read-only default for optional nested objects, so lookups allocate nothing
+_EMPTY = MappingProxyType({})
+
+
+def _bucket(sev_arr, out_counts) -> None:
+    """Tally severity codes into ``out_counts`` (indexed like SEV_BY_CODE)."""
+    for code in sev_arr:
+        out_counts[code] += 1
+
+
+_bucket_jit = njit(cache=True)(_bucket) if njit is not None else None
+
+
+def _tally_severity_codes(codes: array) -> List[int]:
+    """Count each severity code, using the Numba-compiled loop for large scans."""
+    if _bucket_jit is not None and len(codes) >= JIT_MIN_FINDINGS:
+        out_counts = np.zeros(len(SEV_BY_CODE), dtype=np.int64)
+        _bucket_jit(np.frombuffer(codes, dtype=np.int8), out_counts)
+        return out_counts.tolist()
+
+    out_counts = [0] * len(SEV_BY_CODE)
+    _bucket(codes, out_counts)
+    return out_counts
+
+
+def _issue_columns() -> Dict[str, List[Any]]:
+    """Create an empty struct-of-arrays bucket for one severity level."""
+    return {'tool': [], 'type': [], 'description': [], 'file': [], 'line': [], 'rule': []}
+
 
 class SecurityAnalyzer:
     """Analyzes security scan results using AI to make deployment decisions."""
 
-    def __init__(self, api_key: str, model: str = "gpt-4o-mini"):
+    # Token encoders per model, loaded once per process
+    _token_encoders: Dict[str, Any] = {}
+
+    # The per-push commit line of the prompt, excluded from AI cache keys
+    _COMMIT_LINE_RE = re.compile(r'^- Commit: .*$', re.M)
+
+    # Captures every "SECTION: body" block of the AI response in a single pass.
+    # Headers may carry markdown decoration or list numbering such as "**REASONING:**",
+    # "### REASONING:" or "2. REASONING:"
+    _SECTION_RE = re.compile(
+        r'^\W*(?:\d+[.)]\W*)?(REASONING|RECOMMENDATIONS|RISK LEVEL)\W*:[*_]*\s*(.*?)'
+        r'(?=^\W*(?:\d+[.)]\W*)?(?:DECISION|REASONING|RECOMMENDATIONS|RISK LEVEL)\W*:|\Z)',
+        re.S | re.M
+    )
+
+    def __init__(self, api_key: str, model: str = "gpt-4o-mini", use_cache: bool = True,
+                 cache_dir: Path = DEFAULT_CACHE_DIR, batch_endpoint: Optional[str] = None,
+                 mode: str = 'sync', max_kept_per_severity: int = 20):
         """
         Initialize the analyzer with OpenAI credentials.
 
         Args:
             api_key: OpenAI API key
             model: Model to use (default: gpt-4o-mini for cost efficiency)
+            use_cache: Reuse AI decisions for byte-identical prompts
+            cache_dir: Directory holding cached AI decisions
+            batch_endpoint: URL of a batch dispatch service (see batch_dispatch.py)
+                to send prompts to instead of calling OpenAI directly
+            mode: 'sync' for PR-gating runs, or 'batch' to use the discounted
+                OpenAI Batch API for non-urgent scheduled scans
+            max_kept_per_severity: Maximum issues retained per severity for the
+                prompt and report (statistics always reflect the true totals)
         """
-        self.client = openai.OpenAI(api_key=api_key)
+        if mode not in ('sync', 'batch'):
+            raise ValueError(f"Unknown analyzer mode: {mode}")
+        self.http_client = httpx.Client(
+            http2=HTTP2_AVAILABLE,
+            limits=httpx.Limits(max_keepalive_connections=4)
+        )
+        self.client = openai.OpenAI(
+            api_key=api_key,
+            max_retries=OPENAI_MAX_RETRIES,
+            timeout=OPENAI_TIMEOUT,
+            http_client=self.http_client
+        )
         self.model = model
+        self.use_cache = use_cache
+        self.cache_dir = Path(cache_dir)
+        self.batch_endpoint = batch_endpoint
+        self.mode = mode
+        self.max_kept_per_severity = max_kept_per_severity
         self.scan_results = {}
 
     def load_scan_results(self, results_dir: str) -> None:
@@ -35,39 +198,68 @@ class SecurityAnalyzer:
         Args:
             results_dir: Directory containing scan result files
         """
-        results_path = Path(results_dir)
+        asyncio.run(self._load_all(Path(results_dir)))
 
-        # Load Gitleaks results
+    async def _load_all(self, results_path: Path) -> None:
+        """Read the Gitleaks, Semgrep and OPA reports concurrently."""
         gitleaks_file = results_path / "gitleaks-report.json"
-        if gitleaks_file.exists():
-            with open(gitleaks_file) as f:
-                content = f.read().strip()
-                self.scan_results['gitleaks'] = json.loads(content) if content else []
-                print(f"DEBUG: Loaded Gitleaks file, {len(self.scan_results['gitleaks'])} findings")
+        semgrep_file = results_path / "semgrep-report.json"
+        opa_file = results_path / "opa-report.json"
+
+        await asyncio.gather(
+            self._load_one('gitleaks', gitleaks_file, [], stream_prefix='item'),
+            self._load_one('semgrep', semgrep_file, {"results": []}, stream_prefix='results.item'),
+            self._load_one('opa', opa_file, [])
+        )
+
+        # Report what was loaded in a fixed order once every file is in
+        if 'gitleaks_stream' in self.scan_results:
+            print(f"DEBUG: Streaming Gitleaks file ({gitleaks_file.stat().st_size} bytes)")
+        elif gitleaks_file.exists():
+            print(f"DEBUG: Loaded Gitleaks file, {len(self.scan_results['gitleaks'])} findings")
         else:
-            self.scan_results['gitleaks'] = []
             print("DEBUG: Gitleaks report file not found")
 
-        # Load Semgrep results
-        semgrep_file = results_path / "semgrep-report.json"
-        if semgrep_file.exists():
-            with open(semgrep_file) as f:
-                content = f.read().strip()
-                self.scan_results['semgrep'] = json.loads(content) if content else {"results": []}
-        else:
-            self.scan_results['semgrep'] = {"results": []}
+        if 'semgrep_stream' in self.scan_results:
+            print(f"DEBUG: Streaming Semgrep file ({semgrep_file.stat().st_size} bytes)")
 
-        # Load OPA/Conftest results
-        opa_file = results_path / "opa-report.json"
         if opa_file.exists():
-            with open(opa_file) as f:
-                content = f.read().strip()
-                self.scan_results['opa'] = json.loads(content) if content else []
-                print(f"DEBUG: Loaded OPA file, {len(self.scan_results['opa'])} results")
+            print(f"DEBUG: Loaded OPA file, {len(self.scan_results['opa'])} results")
         else:
-            self.scan_results['opa'] = []
             print("DEBUG: OPA report file not found")
 
+    async def _load_one(self, tool: str, path: Path, default: Any, stream_prefix: Optional[str] = None) -> None:
+        """Load one report into scan_results[tool], streaming it instead when very large."""
+        if stream_prefix and self._should_stream(path):
+            self.scan_results[tool] = default
+            # Keep the source rather than an iterator so each aggregation re-reads it
+            self.scan_results[f'{tool}_stream'] = (path, stream_prefix)
+        elif path.exists():
+            self.scan_results[tool] = await self._load_json(path, default)
+        else:
+            self.scan_results[tool] = default
+
+    @staticmethod
+    async def _load_json(path: Path, default: Any) -> Any:
+        """Parse a JSON report straight from its raw bytes, or return default if it is empty."""
+        if aiofiles is not None:
+            async with aiofiles.open(path, 'rb') as f:
+                raw = (await f.read()).strip()
+        else:
+            raw = (await asyncio.to_thread(path.read_bytes)).strip()
+        return _json_loads(raw) if raw else default
+
+    @staticmethod
+    def _should_stream(path: Path) -> bool:
+        """Check whether a report is large enough to be parsed incrementally."""
+        return ijson is not None and path.exists() and path.stat().st_size > STREAM_THRESHOLD_BYTES
+
+    @staticmethod
+    def _stream_items(path: Path, prefix: str):
+        """Lazily yield the items under ``prefix`` of a JSON report, one at a time."""
+        with open(path, 'rb') as f:
+            yield from ijson.items(f, prefix, use_float=True)
+
     def aggregate_findings(self) -> Dict[str, Any]:
         """
         Aggregate and structure findings from all security tools.
@@ -75,105 +267,148 @@ class SecurityAnalyzer:
         Returns:
             Dictionary with aggregated findings and statistics
         """
+        # Each severity holds parallel columns (tool, type, description, file,
+        # line, rule) instead of one dict per issue
         findings = {
-            'critical': [],
-            'high': [],
-            'medium': [],
-            'low': [],
-            'info': [],
+            SEV_CRIT: _issue_columns(),
+            SEV_HIGH: _issue_columns(),
+            SEV_MED: _issue_columns(),
+            SEV_LOW: _issue_columns(),
+            SEV_INFO: _issue_columns(),
             'statistics': {
                 'total_issues': 0,
-                'critical_count': 0,
-                'high_count': 0,
-                'medium_count': 0,
-                'low_count': 0,
+                'counts': Counter(),
+                'duplicates_collapsed': 0,
                 'tools_run': []
             }
         }
+        counts = findings['statistics']['counts']
+        # Only the first max_kept issues per severity are stored; counts cover everything
+        max_kept = self.max_kept_per_severity
+        # Identical (tool, rule, file, description) issues are stored once. Only issues
+        # reaching a non-full bucket are fingerprinted, which keeps the set bounded, so
+        # duplicates_collapsed is a lower bound once a severity hits max_kept
+        seen = set()
 
         # Process Gitleaks results (secrets)
-        gitleaks_results = self.scan_results.get('gitleaks', [])
-        if gitleaks_results:
-            findings['statistics']['tools_run'].append('Gitleaks')
-            for finding in gitleaks_results:
-                issue = {
-                    'tool': 'Gitleaks',
-                    'type': 'Secret Detection',
-                    'description': finding.get('Description', 'Secret detected'),
-                    'file': finding.get('File', 'unknown'),
-                    'line': finding.get('StartLine', 'unknown'),
-                    'severity': 'critical',
-                    'rule': finding.get('RuleID', 'unknown')
-                }
-                findings['critical'].append(issue)
-                findings['statistics']['critical_count'] += 1
+        # Large reports are streamed afresh on every call rather than held as a list
+        gitleaks_stream = self.scan_results.get('gitleaks_stream')
+        gitleaks_results = (self._stream_items(*gitleaks_stream) if gitleaks_stream
+                            else self.scan_results.get('gitleaks', []))
+        gitleaks_seen = False
+        cols = findings[SEV_CRIT]
+        for finding in gitleaks_results:
+            gitleaks_seen = True
+            counts[SEV_CRIT] += 1
+            if len(cols['tool']) >= max_kept:
+                continue
+            description = finding.get('Description', 'Secret detected')
+            file = finding.get('File', 'unknown')
+            rule = finding.get('RuleID', 'unknown')
+            fingerprint = (TOOL_GITLEAKS, rule, file, description)
+            if fingerprint in seen:
+                findings['statistics']['duplicates_collapsed'] += 1
+                continue
+            seen.add(fingerprint)
+            cols['tool'].append(TOOL_GITLEAKS)
+            cols['type'].append('Secret Detection')
+            cols['description'].append(description)
+            cols['file'].append(file)
+            cols['line'].append(finding.get('StartLine', 'unknown'))
+            cols['rule'].append(rule)
+        if gitleaks_seen:
+            findings['statistics']['tools_run'].append(TOOL_GITLEAKS)
 
         # Process Semgrep results (code security)
-        semgrep_results = self.scan_results.get('semgrep', {}).get('results', [])
-        if semgrep_results:
-            findings['statistics']['tools_run'].append('Semgrep')
-            for finding in semgrep_results:
-                severity_map = {
-                    'ERROR': 'high',
-                    'WARNING': 'medium',
-                    'INFO': 'low'
-                }
-                severity = severity_map.get(finding.get('extra', {}).get('severity', 'INFO'), 'low')
-
-                issue = {
-                    'tool': 'Semgrep',
-                    'type': 'Code Security',
-                    'description': finding.get('extra', {}).get('message', 'Security issue detected'),
-                    'file': finding.get('path', 'unknown'),
-                    'line': finding.get('start', {}).get('line', 'unknown'),
-                    'severity': severity,
-                    'rule': finding.get('check_id', 'unknown')
-                }
-                findings[severity].append(issue)
-                findings['statistics'][f'{severity}_count'] += 1
+        semgrep_stream = self.scan_results.get('semgrep_stream')
+        semgrep_results = (self._stream_items(*semgrep_stream) if semgrep_stream
+                           else self.scan_results.get('semgrep', {}).get('results', []))
+        semgrep_seen = False
+        semgrep_codes = array('b')
+        sev_code = SEMGREP_SEV_CODES.get
+        for finding in semgrep_results:
+            semgrep_seen = True
+            extra = finding.get('extra', _EMPTY)
+            code = sev_code(extra.get('severity', 'INFO'), 0)
+            semgrep_codes.append(code)
+
+            cols = findings[SEV_BY_CODE[code]]
+            if len(cols['tool']) >= max_kept:
+                continue
+            description = extra.get('message', 'Security issue detected')
+            file = finding.get('path', 'unknown')
+            rule = finding.get('check_id', 'unknown')
+            fingerprint = (TOOL_SEMGREP, rule, file, description)
+            if fingerprint in seen:
+                findings['statistics']['duplicates_collapsed'] += 1
+                continue
+            seen.add(fingerprint)
+            cols['tool'].append(TOOL_SEMGREP)
+            cols['type'].append('Code Security')
+            cols['description'].append(description)
+            cols['file'].append(file)
+            cols['line'].append(finding.get('start', _EMPTY).get('line', 'unknown'))
+            cols['rule'].append(rule)
+        for code, count in enumerate(_tally_severity_codes(semgrep_codes)):
+            if count:
+                counts[SEV_BY_CODE[code]] += count
+        if semgrep_seen:
+            findings['statistics']['tools_run'].append(TOOL_SEMGREP)
 
         # Process OPA/Conftest results (policy violations)
         opa_results = self.scan_results.get('opa', [])
         if opa_results:
-            findings['statistics']['tools_run'].append('OPA/Conftest')
+            findings['statistics']['tools_run'].append(TOOL_OPA)
             print(f"DEBUG: OPA results structure: {opa_results[:1]}")  # Show first result
             for result in opa_results:
                 # Handle both array of failures and structured results
-                failures = result.get('failures', []) if isinstance(result, dict) else []
-                warnings = result.get('warnings', []) if isinstance(result, dict) else []
+                failures = result.get('failures', ()) if isinstance(result, dict) else ()
+                warnings = result.get('warnings', ()) if isinstance(result, dict) else ()
                 print(f"DEBUG: Result has {len(failures)} failures, {len(warnings)} warnings")
 
+                # Policy results carry no line numbers
+                cols = findings[SEV_HIGH]
                 for failure in failures:
-                    issue = {
-                        'tool': 'OPA/Conftest',
-                        'type': 'Policy Violation',
-                        'description': failure.get('msg', 'Policy violation detected'),
-                        'file': result.get('filename', 'infrastructure'),
-                        'severity': 'high',
-                        'rule': 'policy-enforcement'
-                    }
-                    findings['high'].append(issue)
-                    findings['statistics']['high_count'] += 1
-
+                    counts[SEV_HIGH] += 1
+                    if len(cols['tool']) >= max_kept:
+                        continue
+                    description = failure.get('msg', 'Policy violation detected')
+                    file = result.get('filename', 'infrastructure')
+                    fingerprint = (TOOL_OPA, 'policy-enforcement', file, description)
+                    if fingerprint in seen:
+                        findings['statistics']['duplicates_collapsed'] += 1
+                        continue
+                    seen.add(fingerprint)
+                    cols['tool'].append(TOOL_OPA)
+                    cols['type'].append('Policy Violation')
+                    cols['description'].append(description)
+                    cols['file'].append(file)
+                    cols['line'].append('N/A')
+                    cols['rule'].append('policy-enforcement')
+
+                cols = findings[SEV_MED]
                 for warning in warnings:
-                    issue = {
-                        'tool': 'OPA/Conftest',
-                        'type': 'Policy Warning',
-                        'description': warning.get('msg', 'Policy warning'),
-                        'file': result.get('filename', 'infrastructure'),
-                        'severity': 'medium',
-                        'rule': 'policy-warning'
-                    }
-                    findings['medium'].append(issue)
-                    findings['statistics']['medium_count'] += 1
-
-        # Calculate total issues
-        findings['statistics']['total_issues'] = (
-            findings['statistics']['critical_count'] +
-            findings['statistics']['high_count'] +
-            findings['statistics']['medium_count'] +
-            findings['statistics']['low_count']
-        )
+                    counts[SEV_MED] += 1
+                    if len(cols['tool']) >= max_kept:
+                        continue
+                    description = warning.get('msg', 'Policy warning')
+                    file = result.get('filename', 'infrastructure')
+                    fingerprint = (TOOL_OPA, 'policy-warning', file, description)
+                    if fingerprint in seen:
+                        findings['statistics']['duplicates_collapsed'] += 1
+                        continue
+                    seen.add(fingerprint)
+                    cols['tool'].append(TOOL_OPA)
+                    cols['type'].append('Policy Warning')
+                    cols['description'].append(description)
+                    cols['file'].append(file)
+                    cols['line'].append('N/A')
+                    cols['rule'].append('policy-warning')
+
+        # Calculate total issues and flatten counts into the legacy *_count keys
+        findings['statistics']['total_issues'] = sum(counts.values())
+        for severity in SEVERITIES:
+            findings['statistics'][f'{severity}_count'] = counts[severity]
 
         if not findings['statistics']['tools_run']:
             findings['statistics']['tools_run'] = ['All security tools']
@@ -193,7 +428,7 @@ class SecurityAnalyzer:
         """
         stats = findings['statistics']
 
-        prompt = f"""You are a security deployment reviewer for a CI/CD pipeline. Analyze the following security scan results and make a deployment decision.
+        parts = [f"""You are a security deployment reviewer for a CI/CD pipeline. Analyze the following security scan results and make a deployment decision.
 
 DEPLOYMENT CONTEXT:
 - Branch: {context.get('branch', 'main')}
@@ -209,33 +444,65 @@ SECURITY SCAN SUMMARY:
 - Low: {stats['low_count']}
 
 DETAILED FINDINGS:
-"""
-
-        # Add critical findings
-        if findings['critical']:
-            prompt += "\nCRITICAL ISSUES:\n"
-            for issue in findings['critical'][:5]:  # Limit to 5 for token efficiency
-                prompt += f"- [{issue['tool']}] {issue['description']}\n"
-                prompt += f"  File: {issue['file']}, Line: {issue.get('line', 'N/A')}\n"
+"""]
+
+        # Add critical then high findings until the token budget is spent
+        critical = findings['critical']
+        high = findings['high']
+        sections = (
+            ("\nCRITICAL ISSUES:\n",
+             [(f"- [{tool}] ", description, f"\n  File: {file}, Line: {line}\n")
+              for tool, description, file, line in zip(critical['tool'], critical['description'],
+                                                       critical['file'], critical['line'])]),
+            ("\nHIGH SEVERITY ISSUES:\n",
+             [(f"- [{tool}] ", description, f"\n  File: {file}\n")
+              for tool, description, file in zip(high['tool'], high['description'], high['file'])])
+        )
 
-        # Add high findings
-        if findings['high']:
-            prompt += "\nHIGH SEVERITY ISSUES:\n"
-            for issue in findings['high'][:5]:
-                prompt += f"- [{issue['tool']}] {issue['description']}\n"
-                prompt += f"  File: {issue['file']}\n"
+        # The first row of each severity goes in regardless, so one oversized description
+        # can neither hide the rest of its severity nor the next one
+        picked = []
+        budget = PROMPT_FINDINGS_TOKEN_BUDGET
+        for _, rows in sections:
+            if rows:
+                prefix, description, suffix = rows[0]
+                row = prefix + self._truncate_tokens(description, PROMPT_FIRST_ROW_DESCRIPTION_TOKENS) + suffix
+                picked.append([row])
+                budget -= self._count_tokens(row)
+            else:
+                picked.append([])
+
+        # Remaining rows fill what is left in priority order; a row that does not fit is
+        # skipped so shorter ones after it can still be listed
+        omitted = 0
+        for (_, rows), section_picked in zip(sections, picked):
+            for prefix, description, suffix in rows[1:]:
+                row = prefix + description + suffix
+                tokens = self._count_tokens(row)
+                if tokens > budget:
+                    omitted += 1
+                    continue
+                budget -= tokens
+                section_picked.append(row)
+
+        for (header, _), section_picked in zip(sections, picked):
+            if section_picked:
+                parts.append(header)
+                parts.extend(section_picked)
+        if omitted:
+            parts.append(f"(+{omitted} more critical/high issues not listed; see totals above)\n")
 
         # Add medium findings summary
-        if findings['medium']:
-            prompt += f"\nMEDIUM SEVERITY: {len(findings['medium'])} issues found\n"
-            if findings['medium']:
-                prompt += f"Example: {findings['medium'][0]['description']}\n"
+        medium = findings['medium']
+        if medium['tool']:
+            parts.append(f"\nMEDIUM SEVERITY: {stats['medium_count']} issues found\n"
+                         f"Example: {medium['description'][0]}\n")
 
         # Add low findings summary
-        if findings['low']:
-            prompt += f"\nLOW SEVERITY: {len(findings['low'])} issues found\n"
+        if stats['low_count']:
+            parts.append(f"\nLOW SEVERITY: {stats['low_count']} issues found\n")
 
-        prompt += """
+        parts.append("""
 DECISION CRITERIA:
 1. BLOCK deployment if there are ANY critical issues (secrets, credentials)
 2. BLOCK deployment if there are high-severity issues that pose immediate security risks
@@ -253,9 +520,47 @@ RECOMMENDATIONS:
 [Bullet points with specific remediation steps if blocking, or best practices if approving]
 
 RISK LEVEL: [NONE, LOW, MEDIUM, HIGH, CRITICAL]
-"""
-
-        return prompt
+""")
+
+        return "".join(parts)
+
+    def _count_tokens(self, text: str) -> int:
+        """Count prompt tokens for the configured model, estimating if no encoder is available."""
+        encoder = self._token_encoder()
+        if encoder is None:
+            return len(text) // 4 + 1  # Roughly four characters per token for English text
+        return len(encoder.encode(text))
+
+    def _truncate_tokens(self, text: str, max_tokens: int) -> str:
+        """Cut text to about max_tokens tokens, marking the cut with an ellipsis."""
+        if self._count_tokens(text) <= max_tokens:
+            return text
+        encoder = self._token_encoder()
+        if encoder is None:
+            return text[:max_tokens * 4].rstrip() + "..."
+        return encoder.decode(encoder.encode(text)[:max_tokens]).rstrip() + "..."
+
+    def _token_encoder(self):
+        """Return the cached tiktoken encoder for the configured model, or None."""
+        model = self.model
+        if model not in self._token_encoders:
+            self._token_encoders[model] = self._load_encoder(model)
+        return self._token_encoders[model]
+
+    @staticmethod
+    def _load_encoder(model: str):
+        """Load the tiktoken encoder for a model, or None if tiktoken cannot provide one."""
+        if tiktoken is None:
+            return None
+        try:
+            try:
+                return tiktoken.encoding_for_model(model)
+            except KeyError:
+                return tiktoken.get_encoding('o200k_base')
+        except (OSError, ValueError) as e:  # Encoder files are downloaded on first use
+            print(f"WARNING: Could not load tiktoken encoder for {model}, estimating tokens: {e}",
+                  file=sys.stderr)
+            return None
 
     def analyze_with_ai(self, findings: Dict[str, Any], context: Dict[str, str]) -> Dict[str, Any]:
         """
@@ -270,67 +575,224 @@ RISK LEVEL: [NONE, LOW, MEDIUM, HIGH, CRITICAL]
         """
         prompt = self.create_ai_prompt(findings, context)
 
-        try:
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": "You are an expert security engineer reviewing deployment readiness. Be thorough but practical in your analysis."
-                    },
-                    {
-                        "role": "user",
-                        "content": prompt
-                    }
-                ],
-                temperature=0.3,  # Lower temperature for more consistent decisions
-                max_tokens=500
-            )
-
-            ai_response = response.choices[0].message.content
+        cache_file = self._cache_path(prompt) if self.use_cache else None
+        if cache_file is not None:
+            cached = self._read_cache(cache_file)
+            if cached is not None:
+                print(f"Using cached AI decision from {cache_file}")
+                cached['timestamp'] = datetime.utcnow().isoformat()
+                cached['cached'] = True
+                return cached
 
-            # Parse the AI response
-            decision = "BLOCK_DEPLOYMENT"
-            if "SAFE_TO_DEPLOY" in ai_response:
-                decision = "SAFE_TO_DEPLOY"
-
-            # Extract sections
-            reasoning = self._extract_section(ai_response, "REASONING:")
-            recommendations = self._extract_section(ai_response, "RECOMMENDATIONS:")
-            risk_level = self._extract_section(ai_response, "RISK LEVEL:")
-
-            return {
-                'decision': decision,
-                'reasoning': reasoning.strip(),
-                'recommendations': recommendations.strip(),
-                'risk_level': risk_level.strip().split('\n')[0] if risk_level else 'UNKNOWN',
-                'full_response': ai_response,
-                'model_used': self.model,
-                'timestamp': datetime.utcnow().isoformat()
-            }
+        try:
+            ai_response = self._request_completion(prompt)
+            result = self._parse_ai_response(ai_response)
 
-        except Exception as e:
+        except (openai.APIError, httpx.HTTPError, RuntimeError, ValueError,
+                KeyError, IndexError, TypeError) as e:
+            # API errors arrive here only after the client's own retries are exhausted
             print(f"Error calling OpenAI API: {e}", file=sys.stderr)
             # Fallback to rule-based decision
             return self._fallback_decision(findings)
 
-    def _extract_section(self, text: str, section_marker: str) -> str:
-        """Extract a section from AI response."""
-        if section_marker not in text:
-            return ""
+        # Only cache replies whose sections parsed; a garbled one would otherwise pin its BLOCK
+        if cache_file is not None and result['risk_level'] != 'UNKNOWN' and result['reasoning']:
+            self._write_cache(cache_file, result)
+        return result
+
+    def _request_completion(self, prompt: str) -> str:
+        """Get the raw AI response text, via the batch service if one is configured."""
+        if self.batch_endpoint:
+            return self._post_to_batch_endpoint(prompt)
+        if self.mode == 'batch':
+            return self._request_via_batch_api(prompt)
+
+        response = self.client.chat.completions.create(**self._chat_request_body(prompt))
+
+        if not response.choices:
+            raise ValueError("OpenAI returned no choices")
+        return self._require_content(response.choices[0].message.content)
+
+    @staticmethod
+    def _require_content(content: Any) -> str:
+        """Reject missing or empty completion text so callers fall back instead of parsing it."""
+        if not isinstance(content, str) or not content.strip():
+            raise ValueError("OpenAI returned an empty response")
+        return content
+
+    @staticmethod
+    def _require_dict(payload: Any, what: str) -> Dict[str, Any]:
+        """Reject decoded JSON that is not an object so malformed replies reach the fallback."""
+        if not isinstance(payload, dict):
+            raise ValueError(f"OpenAI {what} is not a JSON object")
+        return payload
+
+    def _chat_request_body(self, prompt: str) -> Dict[str, Any]:
+        """Build the chat completion parameters shared by the sync and Batch API paths."""
+        return {
+            'model': self.model,
+            'messages': [
+                {
+                    "role": "system",
+                    "content": SYSTEM_PROMPT
+                },
+                {
+                    "role": "user",
+                    "content": prompt
+                }
+            ],
+            'temperature': 0.3,  # Lower temperature for more consistent decisions
+            'max_tokens': 500
+        }
+
+    def _request_via_batch_api(self, prompt: str) -> str:
+        """Run the prompt through the OpenAI Batch API and wait for the result."""
+        custom_id = f"guardrail-{os.getenv('GITHUB_RUN_ID', os.getpid())}"
+        request_line = {
+            'custom_id': custom_id,
+            'method': 'POST',
+            'url': '/v1/chat/completions',
+            'body': self._chat_request_body(prompt)
+        }
+        input_file = self.client.files.create(
+            file=('guardrail-batch.jsonl', _json_dumps(request_line) + b"\n"),
+            purpose='batch'
+        )
+        # The batch files hold the full prompt and answer, so none are left in the org's file storage
+        file_ids = [input_file.id]
+        try:
+            batch = self.client.batches.create(
+                input_file_id=input_file.id,
+                endpoint='/v1/chat/completions',
+                completion_window='24h'
+            )
+            print(f"Submitted OpenAI batch {batch.id}, waiting for completion...")
+
+            delay = BATCH_POLL_INITIAL_DELAY
+            deadline = time.monotonic() + BATCH_MAX_WAIT
+            while batch.status not in BATCH_TERMINAL_STATUSES:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    try:
+                        self.client.batches.cancel(batch.id)
+                    except openai.APIError as e:
+                        print(f"WARNING: Could not cancel OpenAI batch {batch.id}: {e}", file=sys.stderr)
+                    raise RuntimeError(f"OpenAI batch {batch.id} did not finish within {BATCH_MAX_WAIT} seconds")
+                time.sleep(min(delay, remaining))
+                delay = min(delay * 2, BATCH_POLL_MAX_DELAY)
+                batch = self.client.batches.retrieve(batch.id)
+            file_ids.extend(file_id for file_id in (batch.output_file_id, batch.error_file_id) if file_id)
+
+            if batch.status != 'completed' or not batch.output_file_id:
+                raise RuntimeError(f"OpenAI batch {batch.id} finished with status '{batch.status}'")
+
+            output = self.client.files.content(batch.output_file_id).content
+            for line in output.splitlines():
+                if not line.strip():
+                    continue
+                result = self._require_dict(_json_loads(line), 'batch output line')
+                if result.get('custom_id') != custom_id:
+                    continue
+                if result.get('error'):
+                    raise RuntimeError(f"OpenAI batch request failed: {result['error']}")
+                response = self._require_dict(result.get('response'), 'batch response')
+                body = self._require_dict(response.get('body'), 'batch response body')
+                choices = body.get('choices')
+                if not isinstance(choices, list) or not choices:
+                    raise ValueError(f"OpenAI batch {batch.id} returned no choices for {custom_id}")
+                message = self._require_dict(self._require_dict(choices[0], 'batch choice').get('message'),
+                                             'batch message')
+                return self._require_content(message.get('content'))
+
+            raise RuntimeError(f"OpenAI batch {batch.id} returned no result for {custom_id}")
+        finally:
+            for file_id in file_ids:
+                try:
+                    self.client.files.delete(file_id)
+                except openai.APIError as e:
+                    print(f"WARNING: Could not delete OpenAI file {file_id}: {e}", file=sys.stderr)
+
+    def _post_to_batch_endpoint(self, prompt: str) -> str:
+        """Submit a prompt to the batch dispatch service and wait for its slice of the answer."""
+        response = self.http_client.post(
+            self.batch_endpoint,
+            content=_json_dumps({'prompt': prompt}),
+            headers={'Content-Type': 'application/json'},
+            timeout=BATCH_ENDPOINT_TIMEOUT
+        )
+        response.raise_for_status()
+        payload = self._require_dict(_json_loads(response.content), 'batch endpoint response')
+        return self._require_content(payload.get('response'))
+
+    def _parse_ai_response(self, ai_response: str) -> Dict[str, Any]:
+        """Turn the AI response text into a structured decision."""
+        decision = "BLOCK_DEPLOYMENT"
+        if "SAFE_TO_DEPLOY" in ai_response:
+            decision = "SAFE_TO_DEPLOY"
+
+        # Extract sections
+        sections = self._parse_sections(ai_response)
+        risk_level = sections.get('RISK LEVEL')
+
+        return {
+            'decision': decision,
+            'reasoning': sections.get('REASONING', ''),
+            'recommendations': sections.get('RECOMMENDATIONS', ''),
+            'risk_level': risk_level.split('\n')[0].strip('*#_ ') if risk_level else 'UNKNOWN',
+            'full_response': ai_response,
+            'model_used': self.model,
+            'timestamp': datetime.utcnow().isoformat()
+        }
 
-        start = text.find(section_marker) + len(section_marker)
-        end = text.find("\n\n", start)
-        if end == -1:
-            # Try finding the next section marker
-            for marker in ["REASONING:", "RECOMMENDATIONS:", "RISK LEVEL:"]:
-                if marker != section_marker and marker in text[start:]:
-                    end = text.find(marker, start)
-                    break
-            if end == -1:
-                end = len(text)
+    def _cache_path(self, prompt: str) -> Path:
+        """Return the cache file for a prompt, keyed on a hash of model and prompt."""
+        # The commit SHA changes on every push; leave it out so unchanged findings still hit
+        keyed_prompt = self._COMMIT_LINE_RE.sub('', prompt)
+        key = hashlib.blake2b(f"{self.model}\n{keyed_prompt}".encode('utf-8'), digest_size=16).hexdigest()
+        return self.cache_dir / f"{key}.json"
 
-        return text[start:end].strip()
+    def _read_cache(self, cache_file: Path) -> Optional[Dict[str, Any]]:
+        """Load a cached AI decision, or None if missing or unreadable."""
+        try:
+            return _json_loads(cache_file.read_bytes())
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            print(f"WARNING: Ignoring unreadable AI cache entry {cache_file}: {e}", file=sys.stderr)
+            return None
+
+    def _write_cache(self, cache_file: Path, result: Dict[str, Any]) -> None:
+        """Atomically store an AI decision so concurrent runs never see partial files."""
+        tmp_file = cache_file.with_name(f"{cache_file.name}.{os.getpid()}.tmp")
+        try:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp_file.write_bytes(_json_dumps(result))
+            os.replace(tmp_file, cache_file)
+        except OSError as e:
+            print(f"WARNING: Could not write AI cache entry {cache_file}: {e}", file=sys.stderr)
+
+    @classmethod
+    def _parse_sections(cls, text: str) -> Dict[str, str]:
+        """
+        Extract all sections from AI response, keeping the first occurrence of each.
+
+        Plain, bold, heading-style and numbered headers are all recognised:
+
+        >>> parse = SecurityAnalyzer._parse_sections
+        >>> parse("REASONING: ok\\nRISK LEVEL: LOW")
+        {'REASONING': 'ok', 'RISK LEVEL': 'LOW'}
+        >>> parse("**REASONING:** Secrets found.\\n\\n**RECOMMENDATIONS:**\\n- rotate\\n\\n**RISK LEVEL:** CRITICAL")
+        {'REASONING': 'Secrets found.', 'RECOMMENDATIONS': '- rotate', 'RISK LEVEL': 'CRITICAL'}
+        >>> parse("### REASONING:\\nSecrets found.\\n### RECOMMENDATIONS:\\n- rotate\\n### RISK LEVEL: CRITICAL")
+        {'REASONING': 'Secrets found.', 'RECOMMENDATIONS': '- rotate', 'RISK LEVEL': 'CRITICAL'}
+        >>> parse("1. REASONING: a\\n2. RECOMMENDATIONS: b\\n3. RISK LEVEL: LOW")
+        {'REASONING': 'a', 'RECOMMENDATIONS': 'b', 'RISK LEVEL': 'LOW'}
+        """
+        sections = {}
+        for match in cls._SECTION_RE.finditer(text):
+            # Drop closing markdown left on the body, e.g. a trailing "**"
+            sections.setdefault(match.group(1), match.group(2).strip().rstrip('*#_').strip())
+        return sections
 
     def _fallback_decision(self, findings: Dict[str, Any]) -> Dict[str, Any]:
         """Fallback rule-based decision if AI fails."""
@@ -377,13 +839,13 @@ RISK LEVEL: [NONE, LOW, MEDIUM, HIGH, CRITICAL]
         stats = findings['statistics']
         decision_emoji = "✅" if ai_decision['decision'] == "SAFE_TO_DEPLOY" else "❌"
 
-        report = f"""# {decision_emoji} SecureDeploy Guardrail Report
+        parts = [f"""# {decision_emoji} SecureDeploy Guardrail Report
 
 ## Decision: {ai_decision['decision'].replace('_', ' ')}
 
 **Risk Level:** {ai_decision['risk_level']}
 **Analysis Time:** {ai_decision['timestamp']}
-**AI Model:** {ai_decision['model_used']}
+**AI Model:** {ai_decision['model_used']}{' (cached decision)' if ai_decision.get('cached') else ''}
 
 ---
 
@@ -408,45 +870,67 @@ RISK LEVEL: [NONE, LOW, MEDIUM, HIGH, CRITICAL]
 | **Total** | **{stats['total_issues']}** |
 
 **Tools Run:** {', '.join(stats['tools_run'])}
-
+"""]
+        if stats.get('duplicates_collapsed'):
+            parts.append(f"**Duplicates Collapsed:** at least {stats['duplicates_collapsed']} "
+                         f"(same tool, rule, file and message; still counted above)\n")
+        parts.append("""
 ---
 
 ## 🔍 Detailed Findings
 
-"""
+""")
 
         # Add critical findings
-        if findings['critical']:
-            report += "### 🔴 Critical Issues\n\n"
-            for issue in findings['critical']:
-                report += f"- **[{issue['tool']}]** {issue['description']}\n"
-                report += f"  - File: `{issue['file']}`\n"
-                report += f"  - Line: {issue.get('line', 'N/A')}\n\n"
+        critical = findings['critical']
+        if critical['tool']:
+            parts.append("### 🔴 Critical Issues\n\n")
+            crit_rows = [f"- **[{tool}]** {description}\n  - File: `{file}`\n  - Line: {line}\n\n"
+                         for tool, description, file, line in zip(critical['tool'], critical['description'],
+                                                                  critical['file'], critical['line'])]
+            parts.append("".join(crit_rows))
 
         # Add high findings
-        if findings['high']:
-            report += "### 🟠 High Severity Issues\n\n"
-            for issue in findings['high']:
-                report += f"- **[{issue['tool']}]** {issue['description']}\n"
-                report += f"  - File: `{issue['file']}`\n\n"
+        high = findings['high']
+        if high['tool']:
+            parts.append("### 🟠 High Severity Issues\n\n")
+            high_rows = [f"- **[{tool}]** {description}\n  - File: `{file}`\n\n"
+                         for tool, description, file in zip(high['tool'], high['description'], high['file'])]
+            parts.append("".join(high_rows))
 
         # Add medium findings
-        if findings['medium']:
-            report += f"### 🟡 Medium Severity Issues ({len(findings['medium'])})\n\n"
-            for issue in findings['medium'][:3]:  # Show first 3
-                report += f"- **[{issue['tool']}]** {issue['description']}\n"
-            if len(findings['medium']) > 3:
-                report += f"\n*...and {len(findings['medium']) - 3} more*\n\n"
+        medium = findings['medium']
+        medium_total = stats['medium_count']
+        if medium_total:
+            parts.append(f"### 🟡 Medium Severity Issues ({medium_total})\n\n")
+            med_rows = [f"- **[{tool}]** {description}\n"
+                        for tool, description in islice(zip(medium['tool'], medium['description']), 3)]  # Show first 3
+            parts.append("".join(med_rows))
+            # The total also counts collapsed duplicates and issues past the retention cap
+            if medium_total > len(med_rows):
+                parts.append(f"\n*...and {medium_total - len(med_rows)} more*\n\n")
+
+        # Critical and high issues are listed in full, so note when some were not kept
+        truncated = [severity for severity in (SEV_CRIT, SEV_HIGH)
+                     if stats[f'{severity}_count'] > len(findings[severity]['tool'])]
+        if truncated:
+            parts.append(f"\n*Not every {' and '.join(truncated)} issue is listed (duplicates are collapsed and "
+                         f"at most {self.max_kept_per_severity} are kept per severity); "
+                         f"the summary table counts every issue.*\n")
 
         # Add summary
-        report += "\n---\n\n"
+        parts.append("\n---\n\n")
         if ai_decision['decision'] == "SAFE_TO_DEPLOY":
-            report += "✅ **Deployment approved by AI Guardrail**\n"
+            parts.append("✅ **Deployment approved by AI Guardrail**\n")
         else:
-            report += "❌ **Deployment blocked by AI Guardrail**\n"
-            report += "\nPlease address the identified issues and push again.\n"
+            parts.append("❌ **Deployment blocked by AI Guardrail**\n"
+                         "\nPlease address the identified issues and push again.\n")
 
-        return report
+        return "".join(parts)
+
+    def save_report(self, report_file: Path, report: str) -> None:
+        """Write the markdown report as UTF-8 regardless of the runner's locale."""
+        report_file.write_text(report, encoding='utf-8')
 
     def set_github_output(self, key: str, value: str) -> None:
         """Set GitHub Actions output variable."""
@@ -460,16 +944,29 @@ RISK LEVEL: [NONE, LOW, MEDIUM, HIGH, CRITICAL]
 
 def main():
     """Main execution function."""
+    parser = argparse.ArgumentParser(description="AI-powered security guardrail analyzer")
+    parser.add_argument('results_dir', nargs='?', default='scan-results',
+                        help="Directory containing scan result files (default: scan-results)")
+    parser.add_argument('--batch-endpoint', metavar='URL', default=os.getenv('GUARDRAIL_BATCH_ENDPOINT'),
+                        help="Send the prompt to a batch dispatch service instead of OpenAI directly")
+    parser.add_argument('--no-cache', action='store_true',
+                        default=os.getenv('GUARDRAIL_NO_CACHE', '').lower() in ('1', 'true', 'yes'),
+                        help="Always ask the AI instead of reusing a cached decision")
+    args = parser.parse_args()
+
     # Get configuration from environment
     api_key = os.getenv('OPENAI_API_KEY')
     if not api_key:
         print("ERROR: OPENAI_API_KEY environment variable not set", file=sys.stderr)
         sys.exit(1)
 
-    results_dir = sys.argv[1] if len(sys.argv) > 1 else 'scan-results'
+    results_dir = args.results_dir
 
     # Initialize analyzer
-    analyzer = SecurityAnalyzer(api_key)
+    # Scheduled scans are not PR-blocking, so they can use the cheaper Batch API
+    mode = 'batch' if os.getenv('GITHUB_EVENT_NAME') == 'schedule' else 'sync'
+    analyzer = SecurityAnalyzer(api_key, use_cache=not args.no_cache,
+                                batch_endpoint=args.batch_endpoint, mode=mode)
 
     # Load scan results
     print(f"Loading scan results from {results_dir}...")
@@ -481,8 +978,12 @@ def main():
 
     # Debug: Print what was found
     print(f"\n=== SCAN RESULTS DEBUG ===")
-    print(f"Gitleaks findings: {len(analyzer.scan_results.get('gitleaks', []))}")
-    print(f"Semgrep findings: {len(analyzer.scan_results.get('semgrep', {}).get('results', []))}")
+    gitleaks_count = ('streamed' if 'gitleaks_stream' in analyzer.scan_results
+                      else len(analyzer.scan_results.get('gitleaks', [])))
+    semgrep_count = ('streamed' if 'semgrep_stream' in analyzer.scan_results
+                     else len(analyzer.scan_results.get('semgrep', {}).get('results', [])))
+    print(f"Gitleaks findings: {gitleaks_count}")
+    print(f"Semgrep findings: {semgrep_count}")
     print(f"OPA findings: {len(analyzer.scan_results.get('opa', []))}")
     print(f"Total issues aggregated: {findings['statistics']['total_issues']}")
     print(f"Critical: {findings['statistics']['critical_count']}")
@@ -506,7 +1007,7 @@ def main():
 
     # Save report
     report_file = Path(results_dir) / 'guardrail-report.md'
-    report_file.write_text(report)
+    analyzer.save_report(report_file, report)
     print(f"Report saved to {report_file}")
 
     # Set GitHub Actions outputs